@@ -5,126 +5,272 @@ This script divides the work of downloading data from a list of URLs among multi
 
 Functionality:
   - Reads environment variables CLOUD_RUN_TASK_INDEX and CLOUD_RUN_TASK_COUNT to determine the current task and total number of tasks.
-  - Reads URLs from data_urls.txt.
+  - Reads URLs from data_urls.msgpack (prebuilt from data_urls.json in the Dockerfile), or from data_urls.json if it is missing.
   - Calculates the range of URLs to process for the current task.
-  - Streams each assigned URL directly into a Google Cloud Storage bucket, deleting any existing object first.
+  - Streams the assigned URLs concurrently (worker processes, each running asyncio + httpx over HTTP/2) into a Google Cloud Storage bucket as gzip-encoded JSON, overwriting any existing objects.
+  - Retries URLs that fail with network or server errors, and lists those that still fail in dead_letter/task_<index>.json in the bucket.
 
 Environment Variables:
   - CLOUD_RUN_TASK_INDEX: The index of the current task (0-based).
   - CLOUD_RUN_TASK_COUNT: The total number of tasks.
   - GCS_BUCKET_NAME: The name of the GCS bucket to use.
+  - CONCURRENCY: The maximum number of URLs each worker process handles at the same time (default 8).
+  - PAGE_SIZE: The maximum number of records requested per API call (default 32000).
+  - UPLOAD_CHUNK_SIZE: The size in bytes of each resumable upload request, rounded up to a multiple of 256 KiB (default 8 MiB).
+  - WORKERS: The number of worker processes the task's URLs are split across (default: CPU count).
+  - MAX_FAILED_URLS: How many URLs may fail all their retries before the task exits with an error (default 0).
 
 Example usage:
   Set the environment variables in your Google Cloud job configuration.
 """
 
 import os
-import math
-import urllib.request
-import json
-import io
-import ijson
+import re
+import sys
+import asyncio
+import gzip
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import httpx
+import msgpack
+import orjson
+import simdjson
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential
+from fixrec import fix_and_dump
 from google.cloud import storage
 
-def fixObject(obj):
-    """
-    Manipulate or fix the object as needed before saving.
-    - If a field is only '-' or 'null' (after trimming), set to empty value.
-    - If field name is 'TEL_MISPAR', pad to 10 characters with zeroes from the left.
-    """
-    fixed = {}
-    for k, v in obj.items():
-        # Convert to string for checks, but preserve None
-        val = v if v is not None else ''
-        # Check for DATA_YEAR == 0
-        if k == 'DATA_YEAR' and (val == 0 or (isinstance(val, str) and val.strip() == '0')):
-            fixed[k] = ''
-            continue
-        if isinstance(val, str):
-            trimmed = val.strip()
-            if trimmed == '-' or trimmed.lower() == 'null':
-                fixed[k] = ''
-            elif k == 'MISPAR_TEL':
-                # Pad TEL_MISPAR to 10 digits with leading zeroes
-                fixed[k] = trimmed.zfill(10)
-            else:
-                fixed[k] = val
-        else:
-            fixed[k] = val
-    return fixed
 
 # Get environment variables for task division
 my_task_num = int(os.environ.get('CLOUD_RUN_TASK_INDEX', '0'))
 total_task_num = int(os.environ.get('CLOUD_RUN_TASK_COUNT', '1'))
 bucket_name = os.environ['GCS_BUCKET_NAME']
+# Capped at 100, the usual limit on concurrent HTTP/2 streams per connection
+concurrency = min(int(os.environ.get('CONCURRENCY', '8')), 100)
+# Each page is held in memory while it is parsed, so this bounds memory per URL in flight.
+# The default matches CKAN's default rows_max, the largest page the server returns anyway.
+page_size = int(os.environ.get('PAGE_SIZE', '32000'))
+# Size of each resumable upload request. The default of 8 MiB covers the bandwidth-delay product
+# of roughly 1 Gbps at 50 ms RTT; GCS requires a multiple of 256 KiB, so the value is rounded up.
+upload_chunk_size = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+upload_chunk_size = -(-upload_chunk_size // (256 * 1024)) * 256 * 1024
+workers = int(os.environ.get('WORKERS', os.cpu_count()))
+max_failed_urls = int(os.environ.get('MAX_FAILED_URLS', '0'))
+
+log = logging.getLogger('datagov')
+
+def setup_logging():
+    """
+    Route log records through a queue to a background thread that writes them to stdout,
+    so that logging from the event loop never waits on the stream.
+    Returns the started listener; stop it to flush pending records before the process exits.
+    """
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(log_queue)], force=True)
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # httpx logs every request at INFO
+    return listener
+
+# Query parameters that page_url() sets itself, removed from the input URL first
+PAGING_PARAMS = re.compile(r'(?<=[?&])(?:limit|offset|include_total)=[^&]*&?')
+
+# Matches a sort parameter already present in the input URL
+SORT_PARAM = re.compile(r'[?&]sort=')
+
+def page_url_prefix(url):
+    """Strip the paging parameters from url once, leaving it ready for page_url() to append to."""
+    base = PAGING_PARAMS.sub('', url).rstrip('?&')
+    sep = '&' if '?' in base else '?'
+    # Offset paging needs a stable order, and CKAN adds no ORDER BY for distinct=true
+    # queries, so sort by _id unless the URL already asks for an order
+    sort = '' if SORT_PARAM.search(base) else 'sort=_id&'
+    return f"{base}{sep}{sort}limit={page_size}&include_total=false&offset="
+
+def page_url(prefix, offset):
+    """Return the URL for the page of records starting at offset."""
+    return f"{prefix}{offset}"
+
+async def fetch_page(client, url):
+    """Download one page of records and return the raw response body."""
+    resp = await client.get(url)
+    resp.raise_for_status()
+    return resp.content
+
+async def produce_chunks(client, url, chunks):
+    """
+    Download, fix and serialize the records of url, putting upload-sized chunks of the
+    JSON array on the chunks queue and None once it is complete.
+    Returns the URL of the last page requested.
+    """
+    pending = bytearray(b'[')
+    first = True
+    # Request the records directly with include_total=false, instead of asking for the total
+    # first, and fetch them page by page by offset. CKAN silently clamps limit to its rows_max,
+    # so a page shorter than page_size is not the end: paging stops at an empty page, or at
+    # one shorter than the limit the server echoes back.
+    prefix = page_url_prefix(url)
+    offset = 0
+    while True:
+        new_url = page_url(prefix, offset)
+        # Parse the page with simdjson and walk the 'records' array lazily,
+        # materializing one record at a time. The parsed document keeps its own copy,
+        # so the raw body is freed as soon as parsing is done. Each page gets a fresh
+        # parser, since a parser cannot be reused while proxies into its last document exist.
+        doc = simdjson.Parser().parse(await fetch_page(client, new_url))
+        records = doc.at_pointer('/result/records')
+        page_records = len(records)
+        try:
+            page_limit = doc.at_pointer('/result/limit')
+        except KeyError:
+            page_limit = None
+        for record in records:
+            if not first:
+                pending += b','
+            else:
+                first = False
+            pending += fix_and_dump(record.as_dict())
+            if len(pending) >= upload_chunk_size:
+                await chunks.put(pending)
+                pending = bytearray()
+        if page_records == 0 or (page_limit is not None and page_records < page_limit):
+            break
+        offset += page_records
+    pending += b']'
+    await chunks.put(pending)
+    await chunks.put(None)
+    return new_url
 
-# Read URL objects from the input JSON file
-with open('data_urls.json', 'r') as f:
-    url_objs = json.load(f)
+async def upload_chunks(writer, chunks):
+    """Write chunks from the queue to writer until None is received."""
+    while (chunk := await chunks.get()) is not None:
+        await asyncio.to_thread(writer.write, chunk)
 
-# Calculate the range of rows assigned to this task
-total_rows = len(url_objs)
-rows_per_task = math.ceil(total_rows / total_task_num)
-start_idx = rows_per_task * my_task_num
-end_idx = min(start_idx + rows_per_task, total_rows)
+# Stream each assigned URL into GCS. Uploads replace any existing object in a single
+# request, so there is no need to delete it first.
+# The GCS client is blocking, so its calls run in worker threads to keep the event loop free.
 
-# Initialize GCS client
-storage_client = storage.Client()
-bucket = storage_client.bucket(bucket_name)
+def is_retryable(e):
+    """Network errors, timeouts and 5xx responses are worth another attempt; 4xx responses are not."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.is_server_error
+    return isinstance(e, (httpx.TransportError, TimeoutError))
 
-# Stream each assigned URL into GCS, deleting any existing object first
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, max=30),
+       retry=retry_if_exception(is_retryable), before_sleep=before_sleep_log(log, logging.WARNING), reraise=True)
+async def transfer(client, blob, url):
+    """Stream the records of url into blob. Returns the URL of the last page requested."""
+    # Stream the rewritten records straight into a resumable upload. Downloading and
+    # serializing run alongside the upload of earlier chunks; the bounded queue between
+    # them caps how many chunks are held in memory.
+    # The JSON is gzip-compressed on the way out and stored with Content-Encoding: gzip;
+    # GCS still serves it decompressed to clients that do not accept gzip.
+    blob.content_encoding = 'gzip'
+    writer = await asyncio.to_thread(
+        blob.open, 'wb', chunk_size=upload_chunk_size, content_type='application/json', timeout=300)
+    compressor = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=4)
+    chunks = asyncio.Queue(maxsize=4)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            producer = tg.create_task(produce_chunks(client, url, chunks))
+            tg.create_task(upload_chunks(compressor, chunks))
+        await asyncio.to_thread(compressor.close)  # Writes the gzip trailer; leaves writer open
+    except BaseException as e:
+        # Cancel the resumable upload so a partial file never replaces the existing object
+        await asyncio.to_thread(writer.terminate)
+        if isinstance(e, ExceptionGroup):
+            raise e.exceptions[0]  # Report the underlying error, not the TaskGroup wrapper
+        raise
+    await asyncio.to_thread(writer.close)
+    return producer.result()
 
-for idx in range(start_idx, end_idx):
-    url = url_objs[idx]['url']
-    name = url_objs[idx]['name']
+async def process(client, semaphore, bucket, url_obj):
+    """Stream one URL into GCS. Returns None on success, or a dead-letter entry once every attempt has failed."""
+    url = url_obj['url']
+    name = url_obj['name']
     blob_name = f"{name}"
     blob = bucket.blob(blob_name)
-    # Delete if exists
-    if blob.exists():
-        blob.delete()
-        print(f"Deleted existing {blob_name} from bucket {bucket_name}")
+    async with semaphore:
+        try:
+            new_url = await transfer(client, blob, url)
+        except Exception as e:
+            log.error(f"Failed to process {url}: {e}")
+            return {'url': url, 'name': name, 'error': str(e)}
+    log.info(f"Downloaded and streamed records array from {new_url} to gs://{bucket_name}/{blob_name}")
+    return None
+
+async def process_all(url_objs):
+    """Process a list of URLs concurrently. Returns the dead-letter entries of the URLs that failed."""
+    # Each worker process opens its own GCS client and HTTP client, so no connection state
+    # is shared across the fork
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    semaphore = asyncio.Semaphore(concurrency)
+    # One HTTP/2 client for the whole worker: every URL is on the same host, so the concurrent
+    # requests are multiplexed over a single keep-alive connection instead of opening one each.
+    # The limits only matter if the server falls back to HTTP/1.1.
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency, keepalive_expiry=60)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=300) as client:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(process(client, semaphore, bucket, url_obj)) for url_obj in url_objs]
+    return [task.result() for task in tasks if task.result() is not None]
+
+def handle(url_objs):
+    """Process a shard of URLs in a worker process. Returns the dead-letter entries of the URLs that failed."""
+    # Worker processes exit without running atexit hooks, so the listener is stopped here
+    listener = setup_logging()
+    try:
+        return asyncio.run(process_all(url_objs))
+    finally:
+        listener.stop()
+
+def main():
+    # Read URL objects from the prebuilt msgpack file, which is cheaper to load than
+    # the input JSON file; fall back to the JSON file when running outside the image
+    if os.path.exists('data_urls.msgpack'):
+        with open('data_urls.msgpack', 'rb') as f:
+            url_objs = msgpack.unpackb(f.read())
+    else:
+        with open('data_urls.json', 'rb') as f:
+            url_objs = orjson.loads(f.read())
+
+    # Calculate the range of rows assigned to this task. The first total_rows % total_task_num
+    # tasks take one extra row, so task sizes differ by at most one.
+    total_rows = len(url_objs)
+    rows_per_task, extra_rows = divmod(total_rows, total_task_num)
+    start_idx = rows_per_task * my_task_num + min(my_task_num, extra_rows)
+    end_idx = start_idx + rows_per_task + (1 if my_task_num < extra_rows else 0)
+
+    # Spread this task's URLs over worker processes, so the CPU-bound parse, fix and
+    # serialize work runs on every core while each worker overlaps its own downloads
+    task_url_objs = url_objs[start_idx:end_idx]
+    shards = [task_url_objs[i::workers] for i in range(min(workers, len(task_url_objs)))]
+    failures = []
+    with ProcessPoolExecutor(max_workers=max(len(shards), 1)) as executor:
+        futures = [executor.submit(handle, shard) for shard in shards]
+        for future in as_completed(futures):
+            failures.extend(future.result())
+
+    # Record the URLs that failed every attempt, so they can be inspected or rerun without
+    # redoing the rest of the task. Written on every run so it never lists stale failures.
+    dead_letter_name = f"dead_letter/task_{my_task_num}.json"
+    dead_letter_blob = storage.Client().bucket(bucket_name).blob(dead_letter_name)
+    dead_letter_blob.upload_from_string(orjson.dumps(failures), content_type='application/json')
+    if len(failures) > max_failed_urls:
+        log.error(f"Task {my_task_num} failed {len(failures)} URLs, see gs://{bucket_name}/{dead_letter_name}")
+        exit(1)  # Exit with error if too many URLs failed
+
+    log.info(f"Task {my_task_num} completed processing URLs from url index {start_idx} to {end_idx - 1} "
+             f"with {len(failures)} failed.")
+    exit(0)  # Exit successfully after processing all URLs
+
+if __name__ == '__main__':
+    listener = setup_logging()
     try:
-        # 1. First request: get total
-        with urllib.request.urlopen(url) as fileobj:
-            resp_json = json.load(fileobj)
-        total = resp_json.get('result', {}).get('total')
-        if total is None:
-            raise Exception(f"No 'total' field found in response for {url}")
-
-        # 2. Second request: get all records
-        # Modify the URL: set limit=total and include_total=false
-        from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-        parsed = urlparse(url)
-        q = parse_qs(parsed.query)
-        q['limit'] = [str(total)]
-        q['include_total'] = ['false']
-        # Remove duplicate keys for clean query string
-        new_query = urlencode({k: v[0] for k, v in q.items()}, doseq=True)
-        new_url = urlunparse((parsed.scheme, parsed.netloc, parsed.path, parsed.params, new_query, parsed.fragment))
-
-        with urllib.request.urlopen(new_url) as fileobj:
-            # Use ijson to stream the 'records' array of objects
-            buffer = io.BytesIO()
-            buffer.write(b'[')
-            first = True
-            for record in ijson.items(fileobj, 'result.records.item'):
-                fixed_record = fixObject(record)
-                if not first:
-                    buffer.write(b',')
-                else:
-                    first = False
-                buffer.write(json.dumps(fixed_record, ensure_ascii=False).encode('utf-8'))
-            buffer.write(b']')
-            buffer.seek(0)
-            blob.upload_from_file(buffer, rewind=True)
-            print(f"Downloaded and streamed records array from {new_url} to gs://{bucket_name}/{blob_name}")
-    except Exception as e:
-        print(f"Failed to process {url}: {e}")
-        exit(1)  # Exit with error if any URL fails
-
-# All URLs processed successfully
-print(f"Task {my_task_num} completed processing URLs from url index {start_idx} to {end_idx - 1}.")
-exit(0)  # Exit successfully after processing all URLs      
+        main()
+    finally:
+        listener.stop()
 
 
 # End of datagov.py
\ No newline at end of file
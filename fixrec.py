@@ -0,0 +1,50 @@
+"""
+fixrec.py
+
+Per-record cleanup applied to every record before it is written to GCS.
+
+The module is plain Python so it can be imported as is, but it is also written to be
+compiled with Cython (`cythonize -3 -i fixrec.py`, done in the Dockerfile). The compiled
+extension takes precedence on import and runs the per-record fix and serialize step
+without Python bytecode dispatch.
+"""
+
+import orjson
+
+# Trimmed, lower-cased string values that mean "no value"
+EMPTY_TOKENS = frozenset(('-', 'null'))
+
+def _fix_value(v):
+    """Blank out string placeholders for missing values; anything else is kept as is."""
+    if isinstance(v, str) and v.strip().lower() in EMPTY_TOKENS:
+        return ''
+    return v
+
+def _fix_tel(v):
+    """Pad MISPAR_TEL to 10 digits with leading zeroes."""
+    if not isinstance(v, str):
+        return v
+    trimmed = v.strip()
+    return '' if trimmed.lower() in EMPTY_TOKENS else trimmed.zfill(10)
+
+def _fix_year(v):
+    """Treat a DATA_YEAR of 0 as empty."""
+    if v == 0 or (isinstance(v, str) and v.strip() == '0'):
+        return ''
+    return _fix_value(v)
+
+# Fields with their own fix; every other field goes through _fix_value
+FIELD_FIXES = {'MISPAR_TEL': _fix_tel, 'DATA_YEAR': _fix_year}
+
+def fixObject(obj):
+    """
+    Manipulate or fix the object as needed before saving.
+    - If a field is None or only '-' or 'null' (after trimming), set to empty value.
+    - If field name is 'MISPAR_TEL', pad to 10 characters with zeroes from the left.
+    - If field name is 'DATA_YEAR' and its value is 0, set to empty value.
+    """
+    return {k: FIELD_FIXES.get(k, _fix_value)('' if v is None else v) for k, v in obj.items()}
+
+def fix_and_dump(obj: dict) -> bytes:
+    """Fix a record and serialize it to compact UTF-8 JSON."""
+    return orjson.dumps(fixObject(obj))